@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+'''This script checks that the two newick parsers in bubbletree (whole array and token by token) build the same tree,
+with the same tips in the same order as Biopython, on the example tree, a random tree and a few edge cases.
+Useage: python3 checknewick.py <-n 1000>'''
+
+import argparse
+import importlib.util
+import io
+import os
+import random
+import sys
+import numpy as np
+from Bio import Phylo
+import generate
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+script = os.path.join(repo, 'bubbletree', 'bubbletree.py')
+
+edgecases = ['(,(,));', '((a,b),,(c,));', '(a:1,(b:2,c)x:3)0.9:0;', '(((a)));']
+
+def loadscript():
+	argv = sys.argv
+	sys.argv = [script, '-i', '', '-t', '', '-m', '', '-a', '', '-s', ''] #arguments are parsed when the script is loaded
+	try:
+		spec = importlib.util.spec_from_file_location('bubbletree', script)
+		bt = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(bt)
+	finally:
+		sys.argv = argv
+	return bt
+
+def check(bt, label, text):
+	arrays = bt.ArrayTree(*bt.newickarrays(text))
+	loop = bt.ArrayTree(*bt.newickloop(text))
+	tips = [str(c.name) for c in Phylo.read(io.StringIO(text), 'newick').get_terminals()]
+	same = np.array_equal(arrays.parent, loop.parent) and list(arrays.name) == list(loop.name) and np.array_equal(arrays.length, loop.length, equal_nan=True)
+	ok = same and arrays.leafnames() == tips and loop.leafnames() == tips
+	print("%-24s %7i nodes %7i tips  %s" % (label, len(arrays), len(tips), 'ok' if ok else 'MISMATCH'))
+	return ok
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--tips', help='Number of tips on the random tree', type=int, default=1000)
+	parser.add_argument('--seed', help='Random seed', type=int, default=1)
+	args = parser.parse_args()
+	bt = loadscript()
+	with open(os.path.join(repo, 'examples', 'tree.tre')) as f:
+		trees = [('examples/tree.tre', f.read()), ('random', generate.randomtree(args.tips, random.Random(args.seed)))]
+	trees += [(t, t) for t in edgecases]
+	results = [check(bt, label, text) for label, text in trees]
+	if not all(results):
+		raise SystemExit('Error! The newick parsers disagree on %i of %i trees.' % (results.count(False), len(results)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+'''This script generates a random tree, a sparse frequency table and a mapping file to benchmark bubbletree with.
+Some ASVs in the table are not on the tree so that filtering is exercised too.
+Useage: python3 generate.py -o outdir -n 10000 -s 500 <-d 0.02> <-f tsv> <-e 0.05> <--seed 1>'''
+
+import argparse
+import os
+import random
+import numpy as np
+from scipy import sparse
+
+def randomtree(ntips, rng):
+	nodes = ['asv%i:%.5f' % (i, rng.random() * 0.05) for i in range(ntips)] #join random pairs until one clade is left
+	while len(nodes) > 1:
+		i = rng.randrange(len(nodes))
+		nodes[i], nodes[-1] = nodes[-1], nodes[i]
+		a = nodes.pop()
+		j = rng.randrange(len(nodes))
+		nodes[j] = '(%s,%s)%i:%.5f' % (a, nodes[j], rng.randrange(101), rng.random() * 0.05)
+	return nodes[0] + ';'
+
+def randomtable(nrows, nsamples, density, seed):
+	nprng = np.random.default_rng(seed)
+	mat = sparse.random(nrows, nsamples, density=density, format='csr', dtype=np.float32, random_state=nprng)
+	mat.data = np.ceil(nprng.lognormal(2, 1.5, size=mat.nnz)).astype(np.float32) #read counts are heavy tailed
+	return mat
+
+def writetsv(path, mat, rowids, colids, chunksize=5000):
+	with open(path, 'w') as f:
+		f.write('\t'.join(['ASVID'] + colids) + '\n')
+		for start in range(0, mat.shape[0], chunksize): #only one block of rows is dense at a time
+			block = mat[start:start + chunksize].toarray()
+			for rowid, row in zip(rowids[start:start + chunksize], block):
+				f.write(rowid + '\t' + '\t'.join('%.1f' % v for v in row) + '\n')
+
+def writenpz(path, mat, rowids, colids):
+	np.savez_compressed(path, data=mat.data, indices=mat.indices, indptr=mat.indptr, shape=np.array(mat.shape), rowids=np.array(rowids, dtype=str), colids=np.array(colids, dtype=str)) #same layout as bubbletree.py --savenpz
+
+def writemap(path, colids, rng):
+	with open(path, 'w') as f:
+		f.write('sampleID\tgroup\tsite\n')
+		for c in colids:
+			f.write('%s\tgroup%i\tsite%i\n' % (c, rng.randrange(5), rng.randrange(12)))
+
+def generate(outdir, ntips, nsamples, density=0.02, fmt='tsv', extra=0.05, seed=1):
+	os.makedirs(outdir, exist_ok=True)
+	rng = random.Random(seed)
+	with open(os.path.join(outdir, 'tree.tre'), 'w') as f:
+		f.write(randomtree(ntips, rng))
+	nrows = ntips + int(ntips * extra)
+	rowids = ['asv%i' % i for i in range(nrows)] #ids past ntips are not on the tree
+	rng.shuffle(rowids)
+	colids = ['sample%i' % i for i in range(nsamples)]
+	mat = randomtable(nrows, nsamples, density, seed)
+	paths = {'tree': os.path.join(outdir, 'tree.tre'), 'map': os.path.join(outdir, 'map.txt')}
+	if fmt in ('tsv', 'both'):
+		paths['tsv'] = os.path.join(outdir, 'biom.txt')
+		writetsv(paths['tsv'], mat, rowids, colids)
+	if fmt in ('npz', 'both'):
+		paths['npz'] = os.path.join(outdir, 'biom.npz')
+		writenpz(paths['npz'], mat, rowids, colids)
+	writemap(paths['map'], colids, rng)
+	return paths
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-o', '--outdir', help='Directory to write tree.tre, map.txt and biom.txt/biom.npz to', required=True)
+	parser.add_argument('-n', '--tips', help='Number of tips on the tree', type=int, required=True)
+	parser.add_argument('-s', '--samples', help='Number of samples in the table', type=int, required=True)
+	parser.add_argument('-d', '--density', help='Fraction of nonzero cells in the table', type=float, default=0.02)
+	parser.add_argument('-f', '--format', help='Write the table as tsv, npz or both', choices=['tsv', 'npz', 'both'], default='tsv')
+	parser.add_argument('-e', '--extra', help='Fraction of extra ASVs in the table that are not on the tree', type=float, default=0.05)
+	parser.add_argument('--seed', help='Random seed', type=int, default=1)
+	args = parser.parse_args()
+	paths = generate(args.outdir, args.tips, args.samples, args.density, args.format, args.extra, args.seed)
+	print("Wrote %s" % ', '.join(sorted(paths.values())))
+
+if __name__ == '__main__':
+	main()
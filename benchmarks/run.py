@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+'''This script runs bubbletree on datasets of increasing size and saves the --profile stage timings of each run,
+so that timings can be compared between releases. The examples directory is the smallest tier, larger tiers are
+generated with generate.py the first time they are used.
+Useage: python3 run.py <-t examples small medium> <-l label> <--compare results/baseline.json>'''
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import generate
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+script = os.path.join(repo, 'bubbletree', 'bubbletree.py')
+
+tiers = OrderedDict([ #tips, samples, density and table format of each generated tier
+	('examples', None),
+	('small', (1000, 100, 0.05, 'tsv')),
+	('medium', (10000, 500, 0.02, 'tsv')),
+	('large', (100000, 1000, 0.01, 'npz')),
+])
+
+def scriptversion():
+	with open(script) as f:
+		return re.search(r'__version__ = "([^"]+)"', f.read()).group(1)
+
+def tierinputs(tier, datadir):
+	if tiers[tier] is None:
+		examples = os.path.join(repo, 'examples')
+		return {'input': os.path.join(examples, 'biom.txt'), 'tree': os.path.join(examples, 'tree.tre'), 'map': os.path.join(examples, 'map.txt'), 'category': 'Habitat2', 'asvids': 'ASVID'}
+	ntips, nsamples, density, fmt = tiers[tier]
+	outdir = os.path.join(datadir, tier)
+	table = os.path.join(outdir, 'biom.txt' if fmt == 'tsv' else 'biom.npz')
+	if not os.path.exists(table): #generated once and reused by later runs
+		print("Generating %s tier (%i tips x %i samples)..." % (tier, ntips, nsamples))
+		generate.generate(outdir, ntips, nsamples, density, fmt)
+	return {'input': table, 'tree': os.path.join(outdir, 'tree.tre'), 'map': os.path.join(outdir, 'map.txt'), 'category': 'group', 'asvids': 'ASVID'}
+
+def runtier(tier, datadir, displays):
+	inputs = tierinputs(tier, datadir)
+	start = time.perf_counter()
+	subprocess.run([sys.executable, script, '-h'], check=True, stdout=subprocess.DEVNULL)
+	helpseconds = time.perf_counter() - start
+	with tempfile.TemporaryDirectory() as tmp: #figures are written to the working directory
+		profile = os.path.join(tmp, 'profile.json')
+		cmd = [sys.executable, script, '-i', inputs['input'], '-t', inputs['tree'], '-m', inputs['map'], '-c', inputs['category'], '-a', inputs['asvids'], '-s', 'sampleID', '-d'] + displays + ['-r', 'True', '-j', '1', '--profile', profile]
+		subprocess.run(cmd, check=True, cwd=tmp, stdout=subprocess.DEVNULL)
+		with open(profile) as f:
+			result = json.load(f)
+	result['help_seconds'] = round(helpseconds, 6)
+	return result
+
+def stagetotals(result):
+	totals = OrderedDict()
+	for t in result['stages']: #figures of the same stage are summed
+		totals[t['stage']] = totals.get(t['stage'], 0) + t['seconds']
+	totals['total'] = result['total_seconds']
+	totals['help'] = result['help_seconds']
+	return totals
+
+def report(results, previous=None):
+	for tier, result in results['tiers'].items():
+		print("\n%s (peak %.0f MB)" % (tier, result['peak_rss_mb'] or 0))
+		old = stagetotals(previous['tiers'][tier]) if previous is not None and tier in previous['tiers'] else {}
+		for name, seconds in stagetotals(result).items():
+			change = ' (%.2fx %s)' % (seconds / old[name], previous['label']) if old.get(name) else ''
+			print("  %-16s %9.3f s%s" % (name, seconds, change))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-t', '--tiers', help='Tiers to run: %s' % ', '.join(tiers), nargs='+', choices=list(tiers), default=['examples', 'small'])
+	parser.add_argument('-d', '--display', help='Displays to draw for every tier', nargs='+', choices=['heatmap', 'bubblechart'], default=['heatmap', 'bubblechart'])
+	parser.add_argument('-l', '--label', help='Name of this run, default is the bubbletree version')
+	parser.add_argument('--datadir', help='Directory for generated tiers', default=os.path.join(here, 'data'))
+	parser.add_argument('--outdir', help='Directory to save results to', default=os.path.join(here, 'results'))
+	parser.add_argument('--compare', help='Earlier results file to compare stage timings against')
+	args = parser.parse_args()
+	label = args.label or scriptversion()
+	results = {'label': label, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'tiers': OrderedDict()}
+	for tier in args.tiers:
+		print("Running %s tier..." % tier)
+		results['tiers'][tier] = runtier(tier, args.datadir, args.display)
+	os.makedirs(args.outdir, exist_ok=True)
+	out = os.path.join(args.outdir, '%s.json' % label)
+	with open(out, 'w') as f:
+		json.dump(results, f, indent=1)
+	previous = None
+	if args.compare is not None:
+		with open(args.compare) as f:
+			previous = json.load(f)
+	report(results, previous)
+	print("\nSaved results to %s" % out)
+
+if __name__ == '__main__':
+	main()
@@ -7,175 +7,1029 @@ Useage: python3 bubble_tree.py -i biom.txt -m mapping.txt -t tree.newick -c cate
 import argparse
 parser = argparse.ArgumentParser()
 requireparser = parser.add_argument_group('required arguments')
-requireparser.add_argument('-i', '--input', help='Frequency table. Must be tsv formatted.', required=True)
+requireparser.add_argument('-i', '--input', help='Frequency table. Can be tsv, BIOM v2 (HDF5), parquet or npz (see --savenpz) formatted, detected from the file contents.', required=True)
 requireparser.add_argument('-t', '--tree', help='Phylogenetic tree', required=True)
 requireparser.add_argument('-m', '--map', help='Mapping file with metadata corresponding to samples. Must be tsv formatted', required=True)
-requireparser.add_argument('-c', '--category', help='Column category from mapping file to order/color samples by', required=True)
 requireparser.add_argument('-a', '--asvids', help='Column name in biom table that contains ASV (or OTU or whatever) ids', required=True)
 requireparser.add_argument('-s', '--sampleids', help='Column name in mapping file that contains sample IDs', required=True)
-parser.add_argument('-d', '--display', help='Display data as a heatmap or bubblechart', default="bubblechart")
-parser.add_argument('-f', '--treeformat', help='Optional: set tree format type. Default is newick formatted tree.', default='newick')
+parser.add_argument('-c', '--category', help='Column category (or categories) from mapping file to order/color samples by. Required unless --batch is given', nargs='+')
+parser.add_argument('-d', '--display', help='Display data as a heatmap or bubblechart (or both)', nargs='+', choices=['heatmap', 'bubblechart'], default=["bubblechart"])
+parser.add_argument('-f', '--treeformat', help='Optional: set tree format type. Default is newick formatted tree (nexus, nexml, phyloxml and cdao are read with Biopython).', default='newick')
 parser.add_argument('-r', '--remote', help='Set this option as True running on a remote cluster. Disables the automatic $DISPLAY environment varible used by matplotlib', type=bool, default='False')
 parser.add_argument('-p', '--previewtree', help='Set this option as True if you want to preview an ASCII version of the imported tree', type=bool)
-parser.add_argument('-n', '--norm', help='Normalize read counts by row (0-1) or log transformation', default='row')
+parser.add_argument('-n', '--norm', help='Normalize read counts by row (0-1), log transformation, relative abundance per sample (relabund) or centered log ratio (clr), both over every ASV in the table and not only those on the tree, or presence/absence (pa)', choices=['row', 'log', 'relabund', 'clr', 'pa'], default='row')
+parser.add_argument('--savenpz', help='Optional: save the ASVs on the tree as a binary npz table that loads faster as --input on later runs (sample totals of the full table are saved with it for relabund and clr)')
+parser.add_argument('--batch', help='Optional: tab separated file with one figure per line, a mapping file category and optionally heatmap or bubblechart')
+parser.add_argument('-j', '--threads', help='Optional: number of processes used to draw figures in parallel. Default is all cores', type=int)
+parser.add_argument('--cache', help='Optional: directory to cache parsed and normalized inputs in, later runs with the same inputs and settings skip straight to plotting')
+parser.add_argument('--cachesize', help='Optional: maximum size of the cache directory in MB, least recently used entries are removed first. Default is 2048', type=float, default=2048)
+parser.add_argument('--collapse', help='Optional: collapse the tree into clades drawn as wedges. MODE is clades (VALUE is the target number of clades), depth (clades VALUE branches from the root), support (bottom-most clades with support >= VALUE, i.e. clades that do not contain another such clade) or length (clades no taller than VALUE)', nargs=2, metavar=('MODE', 'VALUE'))
+parser.add_argument('--aggregate', help='Optional: combine the abundances of collapsed tips by sum, mean or max. Default is sum', choices=['sum', 'mean', 'max'], default='sum')
+parser.add_argument('--clade', help='Optional: only plot the clade with this internal node label, or the smallest clade containing all of these tips', nargs='+')
+parser.add_argument('--asvs', help='Optional: file with one ASV id per line, only these tips are plotted')
+parser.add_argument('--filter', help='Optional: only plot samples where the mapping file COLUMN is one of the comma separated VALUEs. Can be repeated', action='append', metavar='COLUMN=VALUE')
+parser.add_argument('--profile', help='Optional: write the wall time and peak memory of each stage (reading, normalizing, reordering, drawing, saving) to this json file')
 ##TODO: Root tree function
 #parser.add_argument('-o', '--outgroup', help='Root tree either at midpoint or with named outgroup', default='Null')
-args = parser.parse_args()
-
-if args.remote is not None: 
-	import matplotlib
-	matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-import matplotlib.patches as mpatches
+args = parser.parse_args() #parsed before the heavy imports so -h returns straight away
+
+import time
+started = time.perf_counter()
 import pandas as pd
 import numpy as np
-import seaborn as sns
 import os
-from Bio import Phylo
-from itertools import repeat
-
-biom = pd.read_csv(args.input, sep="\t") #load in tab separated biom table 
-print("Reading %s as tsv formatted biom file..." % args.input)
-tree = Phylo.read(args.tree, args.treeformat) #load in tree
-print("Reading %s as %s formatted tree file..." % (args.tree, args.treeformat))
-metadat = pd.read_csv(args.map, sep="\t") #load in mapping file
-print("Reading in %s as mapping file...\n" % args.map)
-print("Generating figure for %s metadata category..." % args.category)
-
-def rownormbubble(x,rmin,rmax):
-	xnorm = (x - rmin)/(rmax - rmin)
-	return xnorm*100
-
-def rownormheat(x,rmin,rmax):
-	xnorm = (x - rmin)/(rmax - rmin)
-	return xnorm
-
-def gennormbubble():
-	biom['rowmax'] = biom.iloc[:, 1:len(biom.columns)].max(axis=1) #first get max and min value for each row and append to dataframe
-	biom['rowmin'] = biom.iloc[:, 1:len(biom.columns)].min(axis=1)
-	# print(biom) # for debugging
-	normdf = pd.DataFrame()
-	samps = list(biom[args.asvids][1:]) #save first column to append to norm dataframe
-	if args.norm == "row":
-		for i in range(1, len(biom)):
-			normdata = biom.iloc[i][1:-2].apply(rownormbubble, args=(biom['rowmin'][i], biom['rowmax'][i])).fillna(0)
-			normdf = normdf.append(normdata)
-		normdf.insert(loc=0, column=args.asvids, value=samps)	
-	elif args.norm == "log":
-		for i in range(1, len(biom)):
-			normdata = np.log10(biom.iloc[i][1:-2].astype(np.float64))
-			normdf = normdf.append(normdata)
-		normdf.insert(loc=0, column=args.asvids, value=samps)
-	reorderbiom(normdf)
-
-def gennormheat():
-	biom['rowmax'] = biom.iloc[:, 1:len(biom.columns)].max(axis=1) #first get max and min value for each row and append to dataframe
-	biom['rowmin'] = biom.iloc[:, 1:len(biom.columns)].min(axis=1)
-	normdf = pd.DataFrame()
-	samps = list(biom[args.asvids][1:]) #save first column to append to norm dataframe
-	if args.norm == "row":
-		for i in range(1, len(biom)):
-			normdata = biom.iloc[i][1:-2].apply(rownormbubble, args=(biom['rowmin'][i], biom['rowmax'][i])).fillna(0)
-			normdf = normdf.append(normdata)
-		normdf.insert(loc=0, column=args.asvids, value=samps)	
-	elif args.norm == "log":
-		for i in range(1, len(biom)):
-			normdata = np.log10(biom.iloc[i][1:-2].astype(np.float64))
-			normdf = normdf.append(normdata)
-		normdf.insert(loc=0, column=args.asvids, value=samps)
-	reorderbiom(normdf)
-
-def reorderbiom(normdf):
-	leaves = [] #get order of leaves from tree
-	for leaf in tree.get_terminals():
-		leaves.append(leaf.name)
-	subset = normdf.loc[normdf[args.asvids].isin(leaves)].set_index(args.asvids) #pull nodes from biom and reorder by leaves in tree
-	ordered = subset.reindex(leaves)
-	filtmeta = metadat[metadat[args.sampleids].isin(list(ordered.columns))] #first remove rows that are not in the biom file
-	grouped = filtmeta.groupby(args.category)[args.sampleids].apply(list) #group samples by metadata category
-	sampOrder = []
-	for i in grouped:
-		sampOrder += i
-	final = ordered.reindex(columns=sampOrder)
-	final.dropna(axis=1, how='all', inplace=True) 	#remove samples if full column is na (i.e., the sample is not present in the biom file)
-	if args.display == 'heatmap':
-		heat(final)
-	elif args.display == 'bubblechart':
-		bubble(final, grouped, filtmeta)
-
-def bubble(final, grouped, filtmeta):
-	x,y = np.meshgrid(final.columns, final.index) #flatten the matrix
-	colmap = sns.color_palette("Set2") + sns.color_palette("Paired") + sns.color_palette("dark") #get color scheme based on grouping category (can do up to 30 categories, add more palettes for more)
-	col = []
-	j = 0
-	for i in grouped:
-		col.extend(repeat(colmap[j], len(i)))
-		j += 1
-	col = col * len(x)
-	legendCol = sorted(set(col), key=lambda x: col.index(x)) #get corresponding legend values (preserve order in color list)
-	legendName = list(filtmeta.groupby(args.category).groups.keys())
-	legendGen = [] #generate legend
-	j = 0
-	for i in legendName:
-		legendGen.append(mpatches.Patch(color=legendCol[j], label=legendName[j]))
-		j += 1	
-	gs = gridspec.GridSpec(1, 2, width_ratios=[0.5, 3]) #set up subplot aesthetics
+import re
+import sys
+import json
+import shutil
+import hashlib
+import heapq
+from scipy import sparse
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+try:
+	import resource
+except ImportError: #not available on windows, peak memory is then left out of --profile
+	resource = None
+
+def importplotting():
+	global plt, gridspec, mpatches, LineCollection, PolyCollection, sns
+	if 'plt' in globals():
+		return
+	with stage('import plotting'): #matplotlib and seaborn are only imported once there is a figure to draw
+		import matplotlib
+		if args.remote is not None:
+			matplotlib.use('Agg')
+		import matplotlib.pyplot as plt
+		import matplotlib.gridspec as gridspec
+		import matplotlib.patches as mpatches
+		from matplotlib.collections import LineCollection, PolyCollection
+		import seaborn as sns
+
+timings = [] #wall time and peak memory of each stage for --profile
+
+def maxrss(who):
+	if resource is None:
+		return None
+	rss = resource.getrusage(who).ru_maxrss
+	return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024 #bytes on macos, kilobytes on linux
+
+def vmhwm():
+	with open('/proc/self/status') as f:
+		for line in f:
+			if line.startswith('VmHWM:'):
+				return int(line.split()[1]) / 1024 #peak resident memory since the last reset, kilobytes to MB
+
+def resethwm():
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5') #peak resident memory starts again from the current resident memory (linux only)
+		return vmhwm() is not None
+	except OSError:
+		return False
+
+perstage = resethwm() #each stage gets its own peak, otherwise stages report how much the process peak grew
+stagepeaks = [] #peaks of the stages that are running, innermost last
+toppeak = [0.0] #peak of this process over every stage, as the stages reset VmHWM
+
+def peakrss():
+	if not perstage:
+		return maxrss(resource.RUSAGE_SELF) if resource is not None else None
+	toppeak[0] = max(toppeak[0], vmhwm())
+	return toppeak[0]
+
+@contextmanager
+def stage(name, **info):
+	if perstage:
+		if stagepeaks: #keep what the enclosing stage reached before the peak is reset
+			stagepeaks[-1] = max(stagepeaks[-1], vmhwm())
+		peakrss()
+		resethwm()
+		stagepeaks.append(0.0)
+	else:
+		before = maxrss(resource.RUSAGE_SELF) if resource is not None else None
+	start = time.perf_counter()
+	yield
+	seconds = round(time.perf_counter() - start, 6)
+	if perstage:
+		peak = max(stagepeaks.pop(), vmhwm())
+		toppeak[0] = max(toppeak[0], peak)
+		if stagepeaks:
+			stagepeaks[-1] = max(stagepeaks[-1], peak)
+		timings.append(dict(stage=name, seconds=seconds, peak_rss_mb=peak, **info))
+	else:
+		timings.append(dict(stage=name, seconds=seconds, rss_delta_mb=None if before is None else maxrss(resource.RUSAGE_SELF) - before, **info))
+
+class ArrayTree(object):
+	'''Compact tree stored as arrays indexed by node number. Nodes are numbered in preorder so the root is node 0
+	and every child has a larger index than its parent.'''
+	def __init__(self, parent, length, name, collapsed=None, ranges=None):
+		self.parent = np.asarray(parent, dtype=np.int64)
+		self.length = np.asarray(length, dtype=np.float64) #nan where the branch length is missing
+		self.name = np.asarray(name, dtype=object)
+		self.collapsed = np.zeros(len(self.parent)) if collapsed is None else np.asarray(collapsed, dtype=np.float64) #height of the clade a tip stands for, 0 for real tips
+		nchild = np.bincount(self.parent[1:], minlength=len(self.parent))
+		self.isleaf = nchild == 0
+		self.childptr = np.concatenate(([0], np.cumsum(nchild))) #children of node i are children[childptr[i]:childptr[i + 1]], in input order
+		self.children = np.argsort(self.parent[1:], kind='stable') + 1
+		self.ranges = ranges #leafrange() arrays, computed on first use
+
+	def __len__(self):
+		return len(self.parent)
+
+	def kids(self, i):
+		return self.children[self.childptr[i]:self.childptr[i + 1]]
+
+	def preorder(self):
+		return np.arange(len(self))
+
+	def postorder(self):
+		order, stack = [], [(0, False)]
+		while stack:
+			i, visited = stack.pop()
+			if visited or self.isleaf[i]:
+				order.append(i)
+			else:
+				stack.append((i, True))
+				stack.extend((k, False) for k in self.kids(i)[::-1])
+		return np.array(order, dtype=np.int64)
+
+	def leaves(self):
+		return np.flatnonzero(self.isleaf) #preorder leaf order is the top to bottom order of the drawn tree
+
+	def leafnames(self):
+		return [str(n) for n in self.name[self.leaves()]]
+
+	def support(self):
+		return pd.to_numeric(pd.Series(self.name), errors='coerce').where(~self.isleaf).values #numeric internal node labels are support values
+
+	def branchlengths(self):
+		return np.nan_to_num(self.length) if not np.isnan(self.length[1:]).all() else np.ones(len(self)) #count edges if there are no branch lengths
+
+	def cladestats(self):
+		lengths, support = self.branchlengths(), self.support()
+		ntips = self.isleaf.astype(np.int64)
+		height = self.collapsed.copy() #longest path from each node down to a tip
+		below = np.full(len(self), -np.inf) #best support of any clade inside each node
+		for i in self.postorder()[:-1]: #one pass, children are finished before their parent
+			p = self.parent[i]
+			ntips[p] += ntips[i]
+			height[p] = max(height[p], height[i] + lengths[i])
+			below[p] = max(below[p], below[i], support[i] if np.isfinite(support[i]) else -np.inf)
+		return ntips, height, below
+
+	def leafrange(self):
+		if self.ranges is None: #one pass over the whole tree, kept for later calls and stored in the cache
+			size = np.ones(len(self), dtype=np.int64) #number of nodes in each subtree
+			for i in range(len(self) - 1, 0, -1): #children come before parents in reverse preorder
+				size[self.parent[i]] += size[i]
+			end = np.arange(len(self)) + size #subtree of node i is nodes i..end[i]-1
+			leafcum = np.concatenate(([0], np.cumsum(self.isleaf)))
+			self.ranges = (leafcum[:-1], leafcum[end], end) #tips of node i are leaves lo[i]..hi[i]-1 in leaf order
+		return self.ranges
+
+	def clade(self, i, end):
+		parent = self.parent[i:end] - i #a subtree is a contiguous block of the preorder arrays
+		parent[0] = -1
+		ranges = None
+		if self.ranges is not None: #so are its leaf ranges
+			lo, hi, ends = self.ranges
+			ranges = (lo[i:end] - lo[i], hi[i:end] - lo[i], ends[i:end] - i)
+		return ArrayTree(parent, self.length[i:end], self.name[i:end], self.collapsed[i:end], ranges)
+
+	def subtree(self, keep):
+		keep = np.asarray(keep, dtype=bool) #nodes to keep, must include the ancestors of every kept node
+		newidx = np.cumsum(keep) - 1
+		parent = np.where(self.parent[keep] >= 0, newidx[self.parent[keep]], -1)
+		return ArrayTree(parent, self.length[keep], self.name[keep], self.collapsed[keep])
+
+	def coords(self):
+		lengths = self.branchlengths()
+		x = np.zeros(len(self))
+		for i in range(1, len(self)): #parents come before children in preorder
+			x[i] = x[self.parent[i]] + lengths[i]
+		y = np.zeros(len(self))
+		y[self.isleaf] = np.arange(self.isleaf.sum()) #leaves sit on matrix rows 0..n-1
+		for i in np.flatnonzero(~self.isleaf)[::-1]: #children come before parents in reverse preorder
+			y[i] = (y[self.children[self.childptr[i]]] + y[self.children[self.childptr[i + 1] - 1]]) / 2
+		return x, y
+
+	def segments(self, x, y): #x, y from coords()
+		kids = np.arange(1, len(self))
+		horizontal = np.stack((np.column_stack((x[self.parent[kids]], y[kids])), np.column_stack((x[kids], y[kids]))), axis=1) #one branch per node
+		inner = np.flatnonzero(~self.isleaf)
+		first, last = self.children[self.childptr[inner]], self.children[self.childptr[inner + 1] - 1]
+		vertical = np.stack((np.column_stack((x[inner], y[first])), np.column_stack((x[inner], y[last]))), axis=1) #one bar spanning the children of each clade
+		return np.concatenate((horizontal, vertical))
+
+	def wedges(self, x, y):
+		tips = np.flatnonzero(self.isleaf & (self.collapsed > 0))
+		return [[(x[i], y[i]), (x[i] + self.collapsed[i], y[i] - 0.4), (x[i] + self.collapsed[i], y[i] + 0.4)] for i in tips] #one triangle per collapsed clade
+
+	def tophylo(self):
+		from Bio import Phylo
+		support = self.support()
+		clades = [Phylo.BaseTree.Clade(name=None if np.isfinite(c) else n, branch_length=None if np.isnan(l) else l, confidence=c if np.isfinite(c) else None) for n, l, c in zip(self.name, self.length, support)]
+		for i in range(1, len(self)): #children are appended in preorder so input order is kept
+			clades[self.parent[i]].clades.append(clades[i])
+		return Phylo.BaseTree.Tree(root=clades[0], rooted=True)
+
+newicktokens = re.compile(r"\s*(?:(\[[^\]]*\])|('(?:[^']|'')*')|([(),:;])|([^(),:;\[\]\s]+))")
+
+def newickloop(text):
+	parent, length, name = [], [], []
+	stack, cur, islength, leafnext = [], None, False, False
+	for comment, quoted, punct, bare in newicktokens.findall(text): #single pass over the tokens, no recursion
+		if comment:
+			continue
+		if leafnext and punct != '(': #a leaf starts after ( or , unless another clade opens, even if it has no name
+			parent.append(stack[-1])
+			length.append(np.nan)
+			name.append(None)
+			cur = len(parent) - 1
+		leafnext = False
+		if punct == '(':
+			parent.append(stack[-1] if stack else -1)
+			length.append(np.nan)
+			name.append(None)
+			stack.append(len(parent) - 1)
+			leafnext = True
+		elif punct == ',':
+			leafnext = True
+		elif punct == ')':
+			cur = stack.pop()
+		elif punct == ':':
+			islength = True
+		elif punct == ';':
+			break
+		else:
+			token = quoted[1:-1].replace("''", "'") if quoted else bare
+			if islength:
+				length[cur] = float(token)
+				islength = False
+			elif cur is None: #tree that is a single leaf
+				parent.append(-1)
+				length.append(np.nan)
+				name.append(token)
+				cur = 0
+			else: #name of the leaf, or label or support value of the clade that was just closed
+				name[cur] = token
+	assert parent and not stack, 'Error! Could not parse tree as newick formatted.'
+	return parent, length, name
+
+newickdelims = str.maketrans('(),:', '\0\0\0\0')
+
+def newickarrays(text):
+	text = text[:text.index(';')] if ';' in text else text
+	raw = np.frombuffer(text.encode(), dtype=np.uint8)
+	pos = np.flatnonzero(np.isin(raw, np.frombuffer(b'(),:', dtype=np.uint8))) #positions of the delimiters
+	ch = raw[pos]
+	seg = text.translate(newickdelims).split('\0')[1:] #text following each delimiter
+	isopen, isclose = ch == ord('('), ch == ord(')')
+	depth = np.cumsum(isopen) - np.cumsum(isclose) #depth after each delimiter
+	nextch = np.append(ch[1:], ord(';'))
+	isleaf = (isopen | (ch == ord(','))) & (nextch != ord('(')) #a leaf starts after ( or , unless another clade opens
+	assert len(ch) and isopen[0] and depth[-1] == 0 and not text[:pos[0]].strip(), 'Error! Could not parse tree as newick formatted.'
+	nodedelim = np.concatenate((np.flatnonzero(isopen), np.flatnonzero(isleaf))) #internal nodes open at (, leaves right after it
+	order = np.argsort(np.concatenate((2 * np.flatnonzero(isopen), 2 * np.flatnonzero(isleaf) + 1)), kind='stable')
+	nodedelim, nodeleaf = nodedelim[order], (order >= isopen.sum()) #nodes in preorder
+	nnode = len(nodedelim)
+	opennode = np.full(len(ch), -1)
+	opennode[nodedelim[~nodeleaf]] = np.flatnonzero(~nodeleaf)
+	leafnode = np.full(len(ch), -1)
+	leafnode[nodedelim[nodeleaf]] = np.flatnonzero(nodeleaf)
+	m = len(ch) + 1
+	openidx = np.flatnonzero(isopen)
+	openkey = depth[openidx] * m + openidx #sorted by depth then position
+	keyorder = np.argsort(openkey)
+	openkey, openidx = openkey[keyorder], openidx[keyorder]
+	def lastopen(d, k): #last ( at or before delimiter k whose depth after opening is d, i.e., the enclosing clade
+		return opennode[openidx[np.searchsorted(openkey, d * m + k, side='right') - 1]]
+	parent = np.full(nnode, -1)
+	parent[1:] = lastopen(depth[nodedelim[1:]] - (~nodeleaf[1:]), nodedelim[1:])
+	closeidx = np.flatnonzero(isclose)
+	closednode = np.full(len(ch), -1)
+	closednode[closeidx] = lastopen(depth[closeidx] + 1, closeidx)
+	name = np.full(nnode, None, dtype=object)
+	leafidx = np.flatnonzero(isleaf)
+	name[leafnode[leafidx]] = [seg[k].strip() or None for k in leafidx.tolist()]
+	labels = [seg[k].strip() or None for k in closeidx.tolist()] #label or support value of the clade that was just closed
+	name[closednode[closeidx]] = labels
+	length = np.full(nnode, np.nan)
+	lenidx = np.flatnonzero(ch == ord(':'))
+	target = np.where(isclose[lenidx - 1], closednode[lenidx - 1], leafnode[lenidx - 1]) #a length belongs to the node finished right before the colon
+	length[target] = np.array([seg[k] for k in lenidx.tolist()], dtype=np.float64)
+	return parent, length, name
+
+def readnewick(path):
+	with open(path) as f:
+		text = f.read()
+	if "'" in text or '[' in text: #quoted labels or comments need the token by token parser
+		return ArrayTree(*newickloop(text))
+	return ArrayTree(*newickarrays(text)) #plain newick is parsed with whole array operations
+
+def fromphylo(phylotree):
+	parent, length, name = [], [], []
+	stack = [(phylotree.root, -1)]
+	while stack: #iterative preorder walk
+		clade, p = stack.pop()
+		parent.append(p)
+		length.append(np.nan if clade.branch_length is None else clade.branch_length)
+		name.append(clade.name if clade.name is not None or clade.confidence is None else str(clade.confidence))
+		stack.extend((c, len(parent) - 1) for c in reversed(clade.clades))
+	return ArrayTree(parent, length, name)
+
+def collapsetree(tree, mode, value):
+	ntips, height, below = tree.cladestats()
+	inner = ~tree.isleaf
+	if mode == 'clades': #split the largest clade until the target number of clades is reached
+		cut = np.zeros(len(tree), dtype=bool)
+		cut[0] = True
+		heap, nclades = [(-ntips[0], 0)], 1
+		while heap:
+			n, i = heapq.heappop(heap)
+			if tree.isleaf[i] or nclades - 1 + len(tree.kids(i)) > value:
+				break
+			cut[i] = False
+			nclades += len(tree.kids(i)) - 1
+			cut[tree.kids(i)] = True
+			for k in tree.kids(i):
+				heapq.heappush(heap, (-ntips[k], k))
+		collapse = cut & inner
+	elif mode == 'depth': #clades this many branches from the root
+		depth = np.zeros(len(tree), dtype=np.int64)
+		for i in range(1, len(tree)):
+			depth[i] = depth[tree.parent[i]] + 1
+		collapse = inner & (depth == int(value))
+	elif mode == 'support': #supported clades with no supported clade inside them
+		collapse = inner & (np.nan_to_num(tree.support(), nan=-np.inf) >= value) & (below < value)
+	elif mode == 'length': #clades no taller than the threshold
+		collapse = inner & (height <= value)
+	owner = np.full(len(tree), -1) #top-most collapsed clade each node belongs to
+	for i in range(len(tree)): #parents come before children in preorder
+		p = tree.parent[i]
+		owner[i] = owner[p] if p >= 0 and owner[p] >= 0 else (i if collapse[i] else -1)
+	keep = (owner < 0) | (owner == np.arange(len(tree))) #drop everything inside a collapsed clade
+	newtree = tree.subtree(keep)
+	clades = np.flatnonzero(keep & ((owner >= 0) | tree.isleaf)) #tips of the collapsed tree, in leaf order
+	newtree.collapsed[newtree.isleaf] = np.where(tree.isleaf[clades], tree.collapsed[clades], height[clades])
+	labelled = np.array([n is not None for n in tree.name]) & ~np.isfinite(tree.support()) #clades keep their own label, otherwise they are named after their first tip
+	first = tree.leaves()[np.searchsorted(tree.leaves(), clades)]
+	newtree.name[newtree.isleaf] = [tree.name[i] if tree.isleaf[i] or labelled[i] else '%s (%i tips)' % (tree.name[f], ntips[i]) for i, f in zip(clades, first)]
+	rank = np.full(len(tree), -1)
+	rank[clades] = np.arange(len(clades))
+	tipclade = rank[np.where(owner >= 0, owner, np.arange(len(tree)))[tree.leaves()]] #clade of each original tip
+	return newtree, tipclade
+
+def aggregate(mat, tipclade, nclades, how):
+	count = np.bincount(tipclade, minlength=nclades).astype(np.float32)
+	if how in ('sum', 'mean'):
+		member = sparse.csr_matrix((np.ones(len(tipclade), dtype=np.float32), (tipclade, np.arange(len(tipclade)))), shape=(nclades, len(tipclade)))
+		out = sparse.csr_matrix(member @ mat)
+		return out if how == 'sum' else scalerows(out, 1 / count.reshape(-1, 1))
+	coo = sparse.coo_matrix(mat) #max of each sample over the tips of a clade
+	rows = tipclade[coo.row]
+	order = np.lexsort((coo.col, rows))
+	rows, cols, data = rows[order], coo.col[order], coo.data[order]
+	if not len(data):
+		return sparse.csr_matrix((nclades, mat.shape[1]), dtype=np.float32)
+	start = np.flatnonzero(np.concatenate(([True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]))))
+	return sparse.csr_matrix((np.maximum.reduceat(data, start), (rows[start], cols[start])), shape=(nclades, mat.shape[1]), dtype=np.float32)
+
+def collapseinputs():
+	global tree, leaves, biom
+	mode, value = args.collapse[0], float(args.collapse[1])
+	tree, tipclade = collapsetree(tree, mode, value)
+	biom = aggregate(biom, tipclade, tree.isleaf.sum(), args.aggregate) #abundances are aggregated before they are normalized
+	leaves = tree.leafnames()
+	print("Collapsed tree by %s %s into %i clades (%s of abundances)...\n" % (mode, args.collapse[1], len(leaves), args.aggregate))
+
+def findclade(names, lo, hi):
+	labels = np.flatnonzero(~tree.isleaf & (tree.name == names[0]))
+	if len(names) == 1 and len(labels):
+		return labels[0] #internal node label
+	leafpos = positions(names, leaves)
+	assert (leafpos >= 0).all(), 'Error! Tips not found in tree: %s' % ', '.join(np.array(names)[leafpos < 0])
+	first, last = leafpos.min(), leafpos.max() + 1
+	node = tree.leaves()[first]
+	while lo[node] > first or hi[node] < last: #walk up to the most recent common ancestor
+		node = tree.parent[node]
+	return node
+
+def subsetinputs(normdf):
+	global tree, leaves
+	if args.clade is not None:
+		lo, hi, end = tree.leafrange()
+		node = findclade(args.clade, lo, hi)
+		normdf = normdf[lo[node]:hi[node]] #rows of a clade are a contiguous slice of the leaf ordered matrix
+		tree = tree.clade(node, end[node])
+		print("Plotting clade of %s (%i tips)..." % (', '.join(args.clade), hi[node] - lo[node]))
+	if args.asvs is not None:
+		with open(args.asvs) as f:
+			asvs = set(line.strip() for line in f if line.strip())
+		tips = tree.leaves()[np.isin(np.array(leaves, dtype=object), list(asvs))]
+		assert len(tips), 'Error! None of the ASVs in %s are tips on the tree.' % args.asvs
+		keep = np.zeros(len(tree), dtype=bool)
+		for i in tips: #keep each listed tip and walk up until an ancestor that is already kept
+			while i >= 0 and not keep[i]:
+				keep[i] = True
+				i = tree.parent[i]
+		normdf = normdf[np.flatnonzero(keep[tree.leaves()])]
+		tree = tree.subtree(keep)
+		print("Plotting %i ASVs listed in %s..." % (len(tips), args.asvs))
+	leaves = tree.leafnames()
+	return normdf
+
+def readtree(path, fmt):
+	if fmt == 'newick':
+		return readnewick(path)
+	from Bio import Phylo
+	return fromphylo(Phylo.read(path, fmt)) #biopython for nexus, nexml, phyloxml and cdao formatted trees
+
+metadat = None
+groups = {} #samples of each metadata category grouped by value
+cacheversion = 4 #bump when the cache layout changes
+chunksize = 10000 #number of biom table rows parsed at a time
+rasterlimit = 10000 #trees and bubble charts with more elements than this are rasterized inside the pdf
+
+def biomformat(path):
+	with open(path, 'rb') as f: #format is detected by the magic bytes of the file, not its extension
+		magic = f.read(8).lstrip() #json may start with whitespace
+	if magic.startswith(b'\x89HDF\r\n\x1a\n'):
+		return 'hdf5'
+	elif magic.startswith(b'PK\x03\x04'):
+		return 'npz'
+	elif magic.startswith(b'PAR1'):
+		return 'parquet'
+	elif magic.startswith(b'{'):
+		raise SystemExit('Error! %s looks like a json formatted BIOM v1 table, which is not supported. Convert it with biom convert -i %s -o table.biom --to-hdf5' % (path, path))
+	return 'tsv' #not a binary format whatever the extension, e.g. a tab separated table saved as .biom
+
+def positions(ids, keep):
+	pos = pd.Series(np.arange(len(keep)), index=keep) #position of each id in keep, -1 if it should be dropped
+	pos = pos[~pos.index.duplicated()]
+	return pos.reindex(ids).fillna(-1).astype(int).values
+
+def addblock(acc, block, rowpos, colpos):
+	block = sparse.coo_matrix(block) #keep nonzero cells of rows on the tree and samples in the mapping file
+	r, c = rowpos[block.row], colpos[block.col]
+	keep = (r >= 0) & (c >= 0) & (block.data != 0)
+	acc[0].append(r[keep])
+	acc[1].append(c[keep])
+	acc[2].append(block.data[keep].astype(np.float32))
+
+def newtotals(nsamples):
+	return {'reads': np.zeros(nsamples), 'logreads': np.zeros(nsamples), 'asvs': 0} #per sample sums over every ASV in the table, not only those on the tree
+
+def addtotals(totals, block, colpos):
+	if sparse.issparse(block):
+		reads, logreads = np.asarray(block.sum(axis=0)).ravel(), np.asarray(block.log1p().sum(axis=0)).ravel()
+	else:
+		reads, logreads = block.sum(axis=0), np.log1p(block).sum(axis=0)
+	keep = colpos >= 0
+	totals['reads'][colpos[keep]] += reads[keep]
+	totals['logreads'][colpos[keep]] += logreads[keep]
+	totals['asvs'] += block.shape[0]
+
+def tsvchunks(path, samples):
+	header = pd.read_csv(path, sep="\t", nrows=0).columns
+	samps = [c for c in header if c != args.asvids and c in samples] #only keep samples that are in the mapping file
+	return samps, pd.read_csv(path, sep="\t", usecols=[args.asvids] + samps, index_col=args.asvids, dtype={c: np.float32 for c in samps}, chunksize=chunksize)
+
+def parquetchunks(path, samples):
+	try:
+		import pyarrow.parquet as pq
+	except ImportError:
+		raise SystemExit('Error! pyarrow is required to read parquet formatted biom tables (pip install pyarrow)')
+	pqfile = pq.ParquetFile(path)
+	samps = [c for c in pqfile.schema_arrow.names if c != args.asvids and c in samples]
+	batches = pqfile.iter_batches(batch_size=chunksize, columns=[args.asvids] + samps) #only the selected columns are decoded
+	return samps, (batch.to_pandas(ignore_metadata=True).set_index(args.asvids) for batch in batches) #ignore the stored pandas index, ASVID may have been saved as one
+
+def readchunks(chunks, acc, leaves, totals):
+	for chunk in chunks:
+		rowpos = positions(chunk.index, leaves)
+		values = chunk.fillna(0).values
+		addtotals(totals, values, np.arange(chunk.shape[1])) #every ASV counts towards the sample totals
+		values = values[rowpos >= 0] #drop ASVs that are not tips on the tree before converting
+		addblock(acc, values, rowpos[rowpos >= 0], np.arange(chunk.shape[1]))
+
+def readhdf5(path, acc, leaves, samples, totals):
+	try:
+		import h5py
+	except ImportError:
+		raise SystemExit('Error! h5py is required to read BIOM v2 (HDF5) formatted biom tables (pip install h5py)')
+	with h5py.File(path, 'r') as f:
+		obsids = f['observation/ids'].asstr()[()]
+		sampids = f['sample/ids'].asstr()[()]
+		samps = [c for c in sampids if c in samples]
+		rowpos, colpos = positions(obsids, leaves), positions(sampids, samps)
+		totals.update(newtotals(len(samps)))
+		indptr = f['observation/matrix/indptr'][()] #matrix is stored as csr by observation, so it is read one block of rows at a time
+		data, indices = f['observation/matrix/data'], f['observation/matrix/indices']
+		for start in range(0, len(obsids), chunksize):
+			end = min(start + chunksize, len(obsids))
+			lo, hi = indptr[start], indptr[end]
+			block = sparse.csr_matrix((data[lo:hi], indices[lo:hi], indptr[start:end + 1] - lo), shape=(end - start, len(sampids)))
+			addtotals(totals, block, colpos) #every block counts towards the sample totals, only blocks with rows on the tree are kept
+			if (rowpos[start:end] >= 0).any():
+				addblock(acc, block, rowpos[start:end], colpos)
+	return samps
+
+def readnpz(path, acc, leaves, samples, totals):
+	with np.load(path, allow_pickle=False) as f: #each array is decompressed whole when first accessed, only the cells of rows on the tree are kept from it
+		rowids, colids = f['rowids'].astype(str), f['colids'].astype(str)
+		samps = [c for c in colids if c in samples]
+		rowpos, colpos = positions(rowids, leaves), positions(colids, samps)
+		indptr = f['indptr']
+		totals.update(newtotals(len(samps)))
+		if 'reads' in f.files: #tables saved with --savenpz only hold the ASVs on the tree, so they carry the totals of the full table
+			keep = colpos >= 0
+			for k in ('reads', 'logreads'):
+				totals[k][colpos[keep]] = f[k][keep]
+			totals['asvs'] = int(f['asvs'])
+		else:
+			addtotals(totals, sparse.csr_matrix((f['data'], f['indices'], indptr), shape=tuple(f['shape'])), colpos)
+		rows = np.flatnonzero(rowpos >= 0)
+		counts = indptr[rows + 1] - indptr[rows] #number of stored cells in each kept row
+		take = np.repeat(indptr[rows] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()) #positions of the kept rows' cells in data and indices
+		data, cols = f['data'][take], colpos[f['indices'][take]]
+	r = np.repeat(rowpos[rows], counts)
+	keep = (cols >= 0) & (data != 0) #then drop samples not in the mapping file
+	acc[0].append(r[keep])
+	acc[1].append(cols[keep])
+	acc[2].append(data[keep].astype(np.float32))
+	return samps
+
+def writenpz(path, mat, rowids, colids, totals):
+	mat = sparse.csr_matrix(mat)
+	np.savez_compressed(path, data=mat.data, indices=mat.indices, indptr=mat.indptr, shape=np.array(mat.shape), rowids=np.array(rowids, dtype=str), colids=np.array(colids, dtype=str), reads=totals['reads'], logreads=totals['logreads'], asvs=np.array(totals['asvs']))
+
+def readbiom(path, leaves, samples):
+	fmt = biomformat(path)
+	acc = ([], [], []) #row, column and value of each nonzero cell, rows are built directly in tree leaf order
+	totals = {}
+	if fmt == 'hdf5':
+		samps = readhdf5(path, acc, leaves, samples, totals)
+	elif fmt == 'npz':
+		samps = readnpz(path, acc, leaves, samples, totals)
+	elif fmt == 'parquet':
+		samps, chunks = parquetchunks(path, samples)
+		totals.update(newtotals(len(samps)))
+		readchunks(chunks, acc, leaves, totals)
+	else:
+		samps, chunks = tsvchunks(path, samples)
+		totals.update(newtotals(len(samps)))
+		readchunks(chunks, acc, leaves, totals)
+	rows, cols, vals = [np.concatenate(a) if a else np.array([], dtype=t) for a, t in zip(acc, (int, int, np.float32))]
+	mat = sparse.csr_matrix((vals, (rows, cols)), shape=(len(leaves), len(samps)), dtype=np.float32)
+	return mat, samps, totals, fmt
+
+def readmap():
+	global metadat
+	with stage('read map'):
+		metadat = pd.read_csv(args.map, sep="\t") #load in mapping file
+	print("Reading in %s as mapping file..." % args.map)
+
+def previewtree():
+	if args.previewtree is not None: #preview tree topology?
+		from Bio import Phylo
+		print("Raw tree preview:\n")
+		Phylo.draw_ascii(tree.tophylo())
+
+def readinputs():
+	global tree, leaves, metadat, biom, samples, totals
+	with stage('read tree'):
+		tree = readtree(args.tree, args.treeformat) #load in tree first so only ASVs on the tree are kept from the biom table
+		leaves = tree.leafnames() #get order of leaves from tree
+	print("Reading %s as %s formatted tree file..." % (args.tree, args.treeformat))
+	previewtree()
+	readmap()
+	with stage('read table'):
+		biom, samples, totals, biomfmt = readbiom(args.input, leaves, set(metadat[args.sampleids])) #load in biom table as a sparse matrix
+	print("Reading %s as %s formatted biom file (%i ASVs on tree x %i samples, %i nonzero)...\n" % (args.input, biomfmt, biom.shape[0], biom.shape[1], biom.nnz))
+	if args.savenpz is not None:
+		writenpz(args.savenpz, biom, leaves, samples, totals)
+		print("Saved ASVs on tree as a binary table to %s (use with -i for faster loading)...\n" % args.savenpz)
+
+def scalerows(x, factor):
+	if sparse.issparse(x):
+		return sparse.diags(factor.ravel()) @ x
+	return x * factor
+
+def scalecols(x, factor):
+	if sparse.issparse(x):
+		return x @ sparse.diags(factor.ravel())
+	return x * factor
+
+def normrow(x):
+	rmin = x.min(axis=1) #min-max scale each row (single tree tip) from 0 to 1
+	rmax = x.max(axis=1)
+	if sparse.issparse(x):
+		rmin, rmax = rmin.toarray(), rmax.toarray()
+		if rmin.any(): #only rows without zeros have a nonzero minimum, so only their stored values are shifted and the matrix stays sparse
+			x = x.tocsr(copy=True) #the input may share its arrays with the cached table
+			x.data -= np.repeat(rmin.ravel(), np.diff(x.indptr))
+			x.eliminate_zeros() #row minimums become zero
+	else:
+		rmin, rmax = rmin[:, None], rmax[:, None]
+	rrange = rmax - rmin
+	rrange[rrange == 0] = 1 #rows with no range (e.g., all zeros) are left at 0 instead of becoming nan
+	if sparse.issparse(x):
+		return scalerows(x, 1 / rrange)
+	return (x - rmin) / rrange
+
+def normlog(x):
+	if sparse.issparse(x):
+		return x.log1p() / np.float32(np.log(10)) #log(0 + 1) is 0, so the sparsity pattern is kept
+	return np.log10(x + 1) #pseudocount of one so that zero counts stay at zero instead of -inf
+
+def normrelabund(x, totals=None):
+	csum = np.asarray(x.sum(axis=0) if totals is None else totals['reads']).reshape(1, -1) #relative abundance of each taxon within a sample, out of all reads of the sample when the table totals are known
+	csum[csum == 0] = 1 #empty samples stay at zero
+	return scalecols(x, 1 / csum)
+
+def normclr(x, totals=None):
+	if sparse.issparse(x):
+		x = x.toarray() #clr transformed zeros are no longer zero
+	logx = np.log(x + 1) #centered log ratio within each sample, pseudocount of one avoids log(0)
+	if totals is None:
+		return logx - logx.mean(axis=0, keepdims=True)
+	return logx - (totals['logreads'] / max(totals['asvs'], 1)).reshape(1, -1) #geometric mean over every ASV in the table
+
+def normpa(x):
+	if sparse.issparse(x):
+		x = x.copy()
+		x.data = (x.data > 0).astype(np.float32)
+		return x
+	return (x > 0).astype(np.float32) #presence/absence
+
+normfuncs = {'row': normrow, 'log': normlog, 'relabund': normrelabund, 'clr': normclr, 'pa': normpa}
+
+def normalize(counts, method, totals=None):
+	if sparse.issparse(counts): #whole matrix operations on float32 (taxa as rows, samples as columns)
+		x = sparse.csr_matrix(counts, dtype=np.float32)
+	else:
+		x = np.asarray(counts, dtype=np.float32)
+	if method in ('relabund', 'clr'): #depend on every ASV of a sample, not only the ones on the tree
+		return normfuncs[method](x, totals).astype(np.float32, copy=False)
+	return normfuncs[method](x).astype(np.float32, copy=False)
+
+def gennorm():
+	return normalize(biom, args.norm, totals) #normalized once and shared by every figure
+
+def groupkey(category):
+	return '|'.join([category] + (args.filter or [])) #groupings depend on the sample filters too
+
+def groupsamples(category):
+	assert category in metadat.columns, 'Error! Category %s is not a column in %s.' % (category, args.map)
+	filtmeta = metadat[metadat[args.sampleids].isin(samples)] #first remove rows that are not in the biom file
+	for f in args.filter or []: #only keep samples matching every metadata filter
+		column, values = f.split('=', 1)
+		assert column in metadat.columns, 'Error! Filter column %s is not a column in %s.' % (column, args.map)
+		filtmeta = filtmeta[filtmeta[column].astype(str).isin(values.split(','))]
+		assert len(filtmeta), 'Error! No samples left after filter %s (filters: %s).' % (f, ', '.join(args.filter))
+	return filtmeta.groupby(category)[args.sampleids].apply(list) #group samples by metadata category
+
+def checkmap(jobs):
+	columns = set(pd.read_csv(args.map, sep="\t", nrows=0).columns) #only the header, so typos are caught before the table is read
+	assert args.sampleids in columns, 'Error! Sample id column %s is not a column in %s.' % (args.sampleids, args.map)
+	for category in dict.fromkeys(c for c, d in jobs):
+		assert category in columns, 'Error! Category %s is not a column in %s.' % (category, args.map)
+	for f in args.filter or []:
+		column = f.split('=', 1)[0]
+		assert column in columns, 'Error! Filter column %s is not a column in %s.' % (column, args.map)
+
+def reorderbiom(normdf, category, display):
+	print("Generating %s figure for %s metadata category..." % (display, category))
+	with stage('reorder', category=category, display=display):
+		grouped = groups[groupkey(category)]
+		sampOrder = []
+		for i in grouped:
+			sampOrder += i
+		sampidx = pd.Series(np.arange(len(samples)), index=samples)[sampOrder].values #rows are already in leaf order, columns are reordered by group while drawing so the shared matrix is never copied
+	if display == 'heatmap':
+		heat(normdf, sampidx, sampOrder, category)
+	elif display == 'bubblechart':
+		bubble(normdf, sampidx, sampOrder, grouped, category)
+
+def setupaxes():
+	fig = plt.figure()
+	gs = gridspec.GridSpec(1, 2, width_ratios=[0.5, 3], figure=fig) #set up subplot aesthetics
 	gs.update(wspace=0.25, hspace=2)
-	treeax=plt.subplot(gs[0], frame_on=False)
-	bubbleax = plt.subplot(gs[1])
-	plt.rc('font', size=0)
-	Phylo.draw(tree, axes=treeax, do_show=False)
-	plt.scatter(x=x.flatten(), y=y.flatten(), s=final.values.flatten(), c=col, zorder=3, edgecolors="black", axes=bubbleax)
-	ax = plt.gca()
-	ax.set_ylim(ax.get_ylim()[::-1]) #flip y axis to match tree
-	ax.grid(True, linestyle="dotted", linewidth=0.2)
-	plt.legend(handles=legendGen, prop={'size': 6}) 
-	plt.xticks(rotation=90)
-	ax.tick_params(axis = 'both', which = 'major', labelsize = 5)
-	treeax.set_ylabel('')
-	treeax.set_xlabel('')
+	treeax = fig.add_subplot(gs[0], frame_on=False)
+	matax = fig.add_subplot(gs[1], sharey=treeax) #tree tips and matrix rows share the same y positions
+	return fig, treeax, matax
+
+def drawtree(treeax):
+	x, y = tree.coords() #computed once for the branches, wedges and axis limits
+	segments = tree.segments(x, y)
+	treeax.add_collection(LineCollection(segments, colors='black', linewidths=0.5, rasterized=len(segments) > rasterlimit)) #whole tree drawn as a single artist
+	wedges = tree.wedges(x, y)
+	if wedges:
+		treeax.add_collection(PolyCollection(wedges, facecolors='lightgrey', edgecolors='black', linewidths=0.5)) #collapsed clades
+	xmax = (x + tree.collapsed).max()
+	treeax.set_xlim(x.min(), xmax * 1.02 if xmax > 0 else 1)
+	treeax.set_ylim(len(leaves) - 0.5, -0.5) #flip y axis so the first leaf is on top
 	treeax.set_xticks([])
-	treeax.set_yticks([])
+	treeax.tick_params(axis='y', which='both', left=False, labelleft=False)
+
+def thinticks(ax, axis, labels, fontsize=5):
+	fig = ax.figure
+	bbox = ax.get_window_extent().transformed(fig.dpi_scale_trans.inverted()) #axis size in inches
+	length = (bbox.height if axis == 'y' else bbox.width) * 72
+	step = max(1, int(np.ceil(len(labels) / max(1, length / (fontsize * 1.2))))) #only label as many ticks as fit without overlapping
+	pos = np.arange(0, len(labels), step)
+	if axis == 'y':
+		ax.set_yticks(pos, [labels[i] for i in pos])
+	else:
+		ax.set_xticks(pos, [labels[i] for i in pos], rotation=90)
+	ax.tick_params(axis=axis, which='major', labelsize=fontsize)
+
+def positivecells(normdf, sampidx):
+	colrank = np.full(normdf.shape[1], -1)
+	colrank[sampidx] = np.arange(len(sampidx)) #column of each sample in the figure, -1 if it is not drawn
+	if sparse.issparse(normdf):
+		rows = np.repeat(np.arange(normdf.shape[0]), np.diff(normdf.indptr))
+		cols, data = colrank[normdf.indices], normdf.data
+	else:
+		rows, cols = np.nonzero(normdf > 0)
+		data, cols = normdf[rows, cols], colrank[cols]
+	keep = (cols >= 0) & (data > 0) #only cells with a positive value are drawn, zero and negative (e.g., clr) values have no area
+	return rows[keep], cols[keep], data[keep]
+
+def bubble(normdf, sampidx, sampOrder, grouped, category):
+	importplotting()
+	y, x, data = positivecells(normdf, sampidx)
+	colmap = sns.color_palette("Set2") + sns.color_palette("Paired") + sns.color_palette("dark") #get color scheme based on grouping category (can do up to 30 categories, add more palettes for more)
+	rgba = np.column_stack((np.array(colmap[:len(grouped)]), np.ones(len(grouped)))) #one RGBA row per group
+	group = np.repeat(np.arange(len(grouped)), [len(i) for i in grouped]) #group index of each sample column
+	legendName = list(grouped.index)
+	legendGen = [mpatches.Patch(color=rgba[j], label=legendName[j]) for j in range(len(legendName))] #generate legend
+	fig, treeax, bubbleax = setupaxes()
+	with stage('draw tree', category=category, display='bubblechart'):
+		drawtree(treeax)
+	with stage('draw matrix', category=category, display='bubblechart'):
+		raster = len(data) > rasterlimit
+		maxsize = 100 #bubble area of the largest value in the matrix
+		if raster: #bubbles of huge matrices are shrunk to fit their cell so they do not overdraw each other
+			bbox = bubbleax.get_window_extent().transformed(fig.dpi_scale_trans.inverted())
+			maxsize = min(maxsize, max(1, min(bbox.height * 72 / len(leaves), bbox.width * 72 / len(sampidx)) ** 2))
+		sizes = data / data.max() * maxsize if data.size else data
+		bubbleax.scatter(x=x, y=y, s=sizes, c=rgba[group[x]], zorder=3, edgecolors="none" if raster else "black", linewidths=0.5, rasterized=raster)
+		bubbleax.set_xlim(-0.5, len(sampidx) - 0.5)
+		bubbleax.grid(True, linestyle="dotted", linewidth=0.2)
+		bubbleax.legend(handles=legendGen, prop={'size': 6}, loc='upper right')
+		thinticks(bubbleax, 'x', sampOrder)
+		thinticks(bubbleax, 'y', leaves)
+		bubbleax.tick_params(axis='y', labelleft=True)
 	#plt.show() #for debugging
-	plt.savefig('%s_bubblePlot.pdf' % args.category, bbox_inches='tight') #save
+	with stage('save', category=category, display='bubblechart'):
+		fig.savefig('%s_bubblePlot.pdf' % category, bbox_inches='tight', dpi=300) #save
+	plt.close(fig)
 
-def heat(final):
-	gs = gridspec.GridSpec(1, 2, width_ratios=[0.5, 3]) #set up plot aesthetics
-	gs.update(wspace=0.25, hspace=2)
-	treeax=plt.subplot(gs[0], frame_on=False)
-	bubbleax = plt.subplot(gs[1])
-	ax = plt.gca()
-	ax.set_ylim(ax.get_ylim()[::-1]) #flip y axis to match tree
-	ax.tick_params(axis = 'both', which = 'major', labelsize = 5)
-	bubbleax.set_ylabel('')
-	plt.rc('font', size=-0)
-	treeax.set_ylabel('')
-	treeax.set_xlabel('')
-	treeax.set_xticks([])
-	treeax.set_yticks([])
-	Phylo.draw(tree, axes=treeax, do_show=False)
-	sns.set(font_scale=1)
-	sns.heatmap(final, mask=False, cmap="YlGnBu", xticklabels=True, yticklabels=True)
+def binpool(n, nbins):
+	bins = np.arange(n) * nbins // n #consecutive rows/columns averaged into each bin
+	counts = np.bincount(bins, minlength=nbins).astype(np.float32)
+	return sparse.csr_matrix((1 / counts[bins], (bins, np.arange(n))), shape=(nbins, n))
+
+def binmatrix(mat, cols, nrows, ncols):
+	select = sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (cols, np.arange(len(cols)))), shape=(mat.shape[1], len(cols))) #picks the drawn sample columns in figure order
+	if mat.shape[0] > nrows: #only the binned matrix is ever dense
+		mat = binpool(mat.shape[0], nrows) @ mat
+	if len(cols) > ncols:
+		select = select @ binpool(len(cols), ncols).T
+	mat = mat @ select
+	return (mat.toarray() if sparse.issparse(mat) else np.asarray(mat)).astype(np.float32, copy=False)
+
+def heat(normdf, sampidx, sampOrder, category):
+	importplotting()
+	fig, treeax, heatax = setupaxes()
+	with stage('draw tree', category=category, display='heatmap'):
+		drawtree(treeax)
+	with stage('draw matrix', category=category, display='heatmap'):
+		bbox = heatax.get_window_extent() #size of the axis in pixels of the saved figure, more rows or columns than this cannot be seen
+		pixels = (max(1, int(bbox.height * 300 / fig.dpi)), max(1, int(bbox.width * 300 / fig.dpi)))
+		values = binmatrix(normdf, sampidx, *pixels)
+		im = heatax.imshow(values, cmap="YlGnBu", aspect='auto', interpolation='nearest', extent=(-0.5, len(sampidx) - 0.5, len(leaves) - 0.5, -0.5)) #drawn as one image, so it is embedded as a raster in the pdf, extent keeps rows lined up with the tree tips
+		fig.colorbar(im, ax=heatax)
+		thinticks(heatax, 'x', sampOrder)
+		thinticks(heatax, 'y', leaves)
+		heatax.tick_params(axis='y', labelleft=True)
 	#plt.show() #for debugging
-	plt.savefig('%s_heatPlot.pdf' % args.category, bbox_inches='tight') #save
+	with stage('save', category=category, display='heatmap'):
+		fig.savefig('%s_heatPlot.pdf' % category, bbox_inches='tight', dpi=300) #save
+	plt.close(fig)
+
+def batchjobs():
+	jobs = [(c, d) for c in (args.category or []) for d in args.display] #every category with every display
+	if args.batch is not None:
+		with open(args.batch) as f: #tab separated category and optional display per line
+			for line in f:
+				fields = [i.strip() for i in line.rstrip('\n').split('\t')]
+				if not fields[0] or fields[0].startswith('#'):
+					continue
+				jobs.append((fields[0], fields[1] if len(fields) > 1 and fields[1] else args.display[0]))
+	jobs = list(dict.fromkeys(jobs)) #drop repeated figures, keep order
+	assert jobs, 'Error! No figures requested. Set a category with -c or a batch file with --batch.'
+	for category, display in jobs:
+		assert display in ('heatmap', 'bubblechart'), 'Error! Display must be heatmap or bubblechart, not %s.' % display
+	return jobs
+
+def sharematrix(mat):
+	arrays = {'data': mat.data, 'indices': mat.indices, 'indptr': mat.indptr} if sparse.issparse(mat) else {'values': np.ascontiguousarray(mat)}
+	spec, shms = {'sparse': sparse.issparse(mat), 'shape': mat.shape, 'arrays': {}}, []
+	for key, arr in arrays.items(): #copy each array into a shared memory block once, workers only get the block names
+		shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+		np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+		spec['arrays'][key] = (shm.name, arr.dtype.str, arr.shape)
+		shms.append(shm)
+	return spec, shms
+
+def attachmatrix(spec):
+	arrays, shms = {}, []
+	for key, (name, dtype, shape) in spec['arrays'].items():
+		shm = shared_memory.SharedMemory(name=name)
+		arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf) #views on the shared block, nothing is copied
+		shms.append(shm)
+	if spec['sparse']:
+		return sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=spec['shape'], copy=False), shms
+	return arrays['values'], shms
+
+def initworker(spec, tree_, leaves_, samples_, groups_):
+	global normshared, shmhandles, tree, leaves, samples, groups
+	del timings[:] #forked workers start with a copy of the main process stages
+	with stage('start worker'):
+		importplotting()
+		plt.switch_backend('Agg') #workers only save figures
+		normshared, shmhandles = attachmatrix(spec)
+	tree, leaves, samples, groups = tree_, leaves_, samples_, groups_
+
+def renderjob(job):
+	reorderbiom(normshared, *job)
+	jobtimings = list(timings) #stages of this figure, and of starting the worker on its first figure
+	del timings[:]
+	return job, jobtimings
+
+def render(normdf, jobs):
+	threads = min(args.threads or os.cpu_count() or 1, len(jobs))
+	if threads == 1:
+		for category, display in jobs:
+			reorderbiom(normdf, category, display)
+		return
+	importplotting() #imported once before the workers are started
+	spec, shms = sharematrix(normdf)
+	try:
+		with ProcessPoolExecutor(threads, initializer=initworker, initargs=(spec, tree, leaves, samples, groups)) as pool:
+			futures = [pool.submit(renderjob, job) for job in jobs]
+			for future in as_completed(futures):
+				(category, display), jobtimings = future.result()
+				timings.extend(dict(t, worker=True) for t in jobtimings)
+				print("Finished %s figure for %s metadata category" % (display, category))
+	except BrokenProcessPool: #a worker died (e.g., killed for running out of memory), fail instead of waiting on it forever
+		raise SystemExit('Error! A worker process drawing figures died unexpectedly. Try fewer processes with -j.')
+	finally:
+		for shm in shms:
+			shm.close()
+			shm.unlink()
+
+def filehash(path):
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def cachekey():
+	settings = [cacheversion, filehash(args.input), filehash(args.tree), filehash(args.map), args.treeformat, args.norm, args.asvids, args.sampleids, args.collapse, args.aggregate] #any change to the inputs or settings gives a new entry
+	return hashlib.blake2b(json.dumps(settings).encode(), digest_size=16).hexdigest()
+
+def writejson(path, obj):
+	with open(path + '.tmp', 'w') as f:
+		json.dump(obj, f)
+	os.replace(path + '.tmp', path) #readers never see a half written file
+
+def loadcache(entry):
+	if not os.path.exists(os.path.join(entry, 'meta.json')):
+		return None
+	with open(os.path.join(entry, 'meta.json')) as f:
+		meta = json.load(f)
+	arrays = {k: np.load(os.path.join(entry, k + '.npy'), mmap_mode='r', allow_pickle=False) for k in meta['arrays']} #memory mapped, only pages that are drawn get read
+	cachedtree = ArrayTree(arrays['parent'], arrays['length'], [n or None for n in arrays['name'].tolist()], arrays['collapsed'], (arrays['lo'], arrays['hi'], arrays['end']))
+	if meta['sparse']:
+		mat = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False)
+	else:
+		mat = arrays['values']
+	cachedgroups = {c: pd.Series(dict(g), dtype=object) for c, g in meta['groups'].items()}
+	os.utime(entry) #mark as recently used
+	return cachedtree, meta['samples'], mat, cachedgroups
+
+def savecache(entry, normdf):
+	tmp = '%s.tmp%i' % (entry, os.getpid())
+	os.makedirs(tmp)
+	arrays = {'parent': tree.parent, 'length': tree.length, 'name': np.array(['' if n is None else n for n in tree.name], dtype=str), 'collapsed': tree.collapsed}
+	arrays.update(zip(('lo', 'hi', 'end'), tree.leafrange())) #so zooming into a clade on a cache hit is only a slice
+	if sparse.issparse(normdf):
+		arrays.update(data=normdf.data, indices=normdf.indices, indptr=normdf.indptr)
+	else:
+		arrays['values'] = normdf
+	for k, v in arrays.items():
+		np.save(os.path.join(tmp, k + '.npy'), v)
+	writejson(os.path.join(tmp, 'meta.json'), {'arrays': list(arrays), 'sparse': sparse.issparse(normdf), 'shape': list(normdf.shape), 'samples': samples, 'groups': {}})
+	try:
+		os.rename(tmp, entry)
+	except OSError: #another run stored the same entry first
+		shutil.rmtree(tmp, ignore_errors=True)
+
+def savegroups(entry, newgroups):
+	with open(os.path.join(entry, 'meta.json')) as f:
+		meta = json.load(f)
+	meta['groups'].update({c: [[str(k), list(v)] for k, v in g.items()] for c, g in newgroups.items()})
+	writejson(os.path.join(entry, 'meta.json'), meta)
+
+def prunecache(keep):
+	entries = []
+	for name in os.listdir(args.cache):
+		path = os.path.join(args.cache, name)
+		if os.path.isdir(path) and '.tmp' not in name:
+			size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+			entries.append((os.path.getmtime(path), path, size))
+	total = sum(e[2] for e in entries)
+	for mtime, path, size in sorted(entries): #least recently used first
+		if total <= args.cachesize * 1024 ** 2:
+			break
+		if path != keep:
+			shutil.rmtree(path, ignore_errors=True)
+			total -= size
+			print("Removed %s from cache..." % path)
+
+def isnumber(value):
+	try:
+		return bool(np.isfinite(float(value)))
+	except ValueError:
+		return False
 
 def main():
+	global tree, leaves, samples
 	assert os.path.exists(args.input), 'Error! File does not exist: %s. Is the path correct?' % args.input
 	assert os.path.exists(args.tree), 'Error! File does not exist: %s. Is the path correct?' % args.tree
 	assert os.path.exists(args.map), 'Error! File does not exist: %s. Is the path correct?' % args.map
-	if args.previewtree is not None: #preview tree topology?
-		print("Raw tree preview:\n")
-		Phylo.draw_ascii(tree)
-	if args.display == "heatmap": #heatmap or bubble plot?
-		gennormheat()
-	elif args.display == "bubblechart":
-		gennormbubble()
-
-main()
+	assert args.batch is None or os.path.exists(args.batch), 'Error! File does not exist: %s. Is the path correct?' % args.batch
+	assert args.asvs is None or os.path.exists(args.asvs), 'Error! File does not exist: %s. Is the path correct?' % args.asvs
+	assert all('=' in f for f in args.filter or []), 'Error! Filters must be formatted as COLUMN=VALUE.'
+	assert args.collapse is None or args.collapse[0] in ('clades', 'depth', 'support', 'length'), 'Error! Collapse mode must be clades, depth, support or length, not %s.' % args.collapse[0]
+	assert args.collapse is None or isnumber(args.collapse[1]), 'Error! Collapse value must be a number, not %s.' % args.collapse[1]
+	jobs = batchjobs()
+	checkmap(jobs)
+	cached, entry = None, None
+	if args.cache is not None:
+		os.makedirs(args.cache, exist_ok=True)
+		with stage('read cache'):
+			entry = os.path.join(args.cache, cachekey())
+			if args.savenpz is None: #the raw table is only read on a cache miss
+				cached = loadcache(entry)
+	if cached is not None:
+		print("Reading parsed and normalized inputs from cache %s...\n" % entry)
+		tree, samples, normdf, cachedgroups = cached
+		leaves = tree.leafnames()
+		groups.update(cachedgroups)
+		previewtree()
+	else:
+		readinputs()
+		if args.collapse is not None:
+			with stage('collapse'):
+				collapseinputs()
+		with stage('normalize'):
+			normdf = gennorm()
+		if entry is not None:
+			with stage('write cache'):
+				savecache(entry, normdf)
+	missing = [c for c in dict.fromkeys(c for c, d in jobs) if groupkey(c) not in groups]
+	if missing:
+		if metadat is None:
+			readmap()
+		groups.update({groupkey(c): groupsamples(c) for c in missing})
+		if entry is not None:
+			savegroups(entry, {groupkey(c): groups[groupkey(c)] for c in missing})
+	if args.clade is not None or args.asvs is not None:
+		with stage('subset'):
+			normdf = subsetinputs(normdf)
+	render(normdf, jobs)
+	if entry is not None:
+		prunecache(entry)
+	if args.profile is not None:
+		mainpeak, workerpeak = peakrss(), maxrss(resource.RUSAGE_CHILDREN) if resource is not None else None #largest worker, workers have all exited by now
+		total = None if mainpeak is None else mainpeak + (workerpeak or 0)
+		writejson(args.profile, {'version': __version__, 'argv': sys.argv[1:], 'total_seconds': round(time.perf_counter() - started, 6), 'peak_rss_mb': total, 'main_peak_rss_mb': mainpeak, 'worker_peak_rss_mb': workerpeak, 'stages': timings})
+		print("Saved stage timings to %s" % args.profile)
 
 __author__ = "Allison E. Mann"
 __license__ = "GPL"
-__version__ = "1.0.1"
+__version__ = "1.1"
 __email__="allison.e.mann@gmail.com"
 
+if __name__ == '__main__':
+	main()
+